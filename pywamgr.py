@@ -1,53 +1,170 @@
 #!/usr/bin/env python
-"""pywamgr - The Python WoW Addon Manager
-
-Usage:
-    pywamgr.py install <addon>...
-    pywamgr.py update (<addon>... | --all)
-    pywamgr.py remove <addon>...
-    pywamgr.py -h | --help
-    pywamgr.py --version
-
-Options:
-    -h --help  Show this screen.
-    --version  Show version.
-    --all      Update all addons.
-    <addon>    Addon name
-"""
-
-from bs4 import BeautifulSoup, SoupStrainer
-from docopt import docopt
-from os.path import expanduser, dirname, basename, isfile, isdir
+"""pywamgr - The Python WoW Addon Manager"""
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from os.path import expanduser, dirname, basename, isfile
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
 from zipfile import ZipFile
+import argparse
+import glob
 import gzip
 import hashlib
-import io
+import html
 import json
+import mmap
 import os
+import re
 import requests
 import shutil
 import sys
+import tempfile
+import threading
 import yaml
 
+# use the libyaml bindings if available
+Loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+Dumper = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+
+# shared between all worker threads so connections get reused
+session = requests.Session()
+session.headers['User-Agent'] = 'pywamgr'
+session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=16,
+                                      max_retries=Retry(total=3,
+                                                        backoff_factor=0.5)))
+
+# matches the download button on a curseforge project's files page, with its
+# attributes in any order
+download_re = re.compile(rb'<a(?=\s)'
+                         rb'(?=[^>]*\sclass="(?:[^"]*\s)?mg-r-05[\s"])'
+                         rb'(?=[^>]*\sdata-action-value="([^"]+)")')
+
+# pruning empty directories may race with another addon creating directories
+# it's about to move files into, as top-level directories can be shared
+disk_lock = threading.Lock()
+
+# sha256 is serial per file, so hash multiple files concurrently instead
+hash_pool = ThreadPoolExecutor(max_workers=os.cpu_count())
+
+def hash_file(path):
+    with open(path, 'rb') as f:
+        # hash large files straight from the page cache on 64-bit systems
+        if sys.maxsize > 2**32 and os.fstat(f.fileno()).st_size >= 1 << 20:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                return hashlib.sha256(mm).digest()
+
+        if hasattr(hashlib, 'file_digest'):
+            return hashlib.file_digest(f, 'sha256').digest()
+
+        # hashlib.file_digest is only available since Python 3.11
+        m = hashlib.sha256()
+        while True:
+            chunk = f.read(1 << 20)
+            if not chunk:
+                break
+            m.update(chunk)
+
+        return m.digest()
+
 def get_curse_addon_data(addon):
     base_url = 'https://www.curseforge.com/wow/addons/{}/'.format(addon)
     project_url = base_url + 'files?sort=releasetype'
 
-    r = requests.get(project_url)
-    soup = BeautifulSoup(r.content, 'html.parser', parse_only=SoupStrainer('a'))
-    elem = soup.find('a', {'class': 'mg-r-05'})['data-action-value']
-    data = json.loads(elem)
+    cachepath = os.path.join('.cache', addon)
+    meta_file = os.path.join(cachepath, 'META.json')
 
-    return [data['FileName'].strip(), base_url +
-            "download/{}/file".format(data['ProjectFileID'])]
+    # send a conditional request if the page has been fetched before
+    headers = {}
+    try:
+        with open(meta_file, 'r') as fd:
+            meta = json.load(fd)
 
-# Updates addon if it's not already up-to-date
-def update_addon(addon, addons_dir):
-    project_data = get_curse_addon_data(addon)
+        if meta['etag']:
+            headers['If-None-Match'] = meta['etag']
+        if meta['last_modified']:
+            headers['If-Modified-Since'] = meta['last_modified']
+    except (OSError, ValueError, KeyError):
+        meta = None
+
+    r = session.get(project_url, headers=headers)
+    if r.status_code == 304 and meta:
+        # page unchanged, reuse the previously extracted data
+        return meta['project_data']
+
+    match = download_re.search(r.content)
+    if not match:
+        raise ValueError('Could not find download data for ' + addon + '.')
+
+    data = json.loads(html.unescape(match.group(1).decode()))
+
+    project_data = [data['FileName'].strip(), base_url +
+                    "download/{}/file".format(data['ProjectFileID'])]
+
+    os.makedirs(cachepath, exist_ok=True)
+    with open(meta_file, 'w') as out:
+        json.dump({'etag': r.headers.get('ETag'),
+                   'last_modified': r.headers.get('Last-Modified'),
+                   'project_data': project_data}, out)
+
+    return project_data
+
+# Reads the list of installed files with their sha256 digest, size and mtime
+def read_mtree(cachepath):
+    try:
+        with open(os.path.join(cachepath, 'MTREE.json'), 'r') as data_file:
+            data = json.load(data_file)
+    except FileNotFoundError:
+        # fall back to the old gzip compressed format
+        with gzip.open(os.path.join(cachepath, 'MTREE'), 'rt') as data_file:
+            data = json.load(data_file)
+
+    # digests are stored as hex but compared as raw bytes
+    return [[entry[0], bytes.fromhex(entry[1])] + entry[2:] for entry in data]
+
+def write_mtree(cachepath, mtree):
+    with open(os.path.join(cachepath, 'MTREE.json'), 'w') as out:
+        json.dump([[entry[0], entry[1].hex()] + entry[2:] for entry in mtree],
+                  out)
+
+    try:
+        os.remove(os.path.join(cachepath, 'MTREE'))
+    except FileNotFoundError:
+        pass
+
+# Returns the path name is installed to, or None if it would end up outside
+# of addons_dir
+def addon_path(addons_dir, name):
+    if '..' in name.replace('\\', '/').split('/'):
+        return None
 
+    root = os.path.abspath(addons_dir)
+    path = os.path.abspath(os.path.join(root, name))
+    try:
+        if path == root or os.path.commonpath([root, path]) != root:
+            return None
+    except ValueError:
+        # paths are on different drives
+        return None
+
+    return path
+
+# Moves the given files from staging to the same place in addons_dir,
+# leaving every other file there alone
+def move_into_place(staging, addons_dir, names):
+    with disk_lock:
+        for d in sorted({dirname(os.path.join(addons_dir, n))
+                         for n in names}):
+            os.makedirs(d, exist_ok=True)
+
+        for name in names:
+            os.replace(os.path.join(staging, name),
+                       os.path.join(addons_dir, name))
+
+# Updates addon if it's not already up-to-date
+def update_addon(addon, addons_dir, project_data):
     new_version = project_data[0]
-    cachepath = '.cache/' + addon
-    version_file = cachepath + '/VERSION'
+    cachepath = os.path.join('.cache', addon)
+    version_file = os.path.join(cachepath, 'VERSION')
     try:
         with open(version_file, 'r') as fd:
             old_version = fd.read()
@@ -59,7 +176,6 @@ def update_addon(addon, addons_dir):
 
             print(addon + ' seems to be broken. Reinstalling.')
 
-        remove_addon(addon, addons_dir)
         print('Updating ' + addon + ' (' + old_version + ' -> ' + new_version
                 + ')')
     except OSError:
@@ -68,107 +184,224 @@ def update_addon(addon, addons_dir):
         except:
             pass
 
-    with open(version_file, 'w') as out:
-        out.write(new_version)
+    # spool the archive to a temporary file instead of holding it in memory
+    tmp = tempfile.SpooledTemporaryFile(max_size=8 << 20)
+    with session.get(project_data[1], stream=True) as r:
+        # undo any Content-Encoding while copying the raw body
+        r.raw.decode_content = True
+        shutil.copyfileobj(r.raw, tmp, 1 << 20)
+    tmp.seek(0)
 
-    r = requests.get(project_data[1], stream=True)
-
-    mtree = []
-    with ZipFile(io.BytesIO(r.content)) as z:
-        for name in z.namelist():
-            m = hashlib.sha256()
-            path = addons_dir + name
-
-            try:
-                os.makedirs(dirname(path))
-            except:
-                pass
+    try:
+        old_mtree = {entry[0]: entry for entry in read_mtree(cachepath)}
+    except:
+        # addon wasn't installed before
+        old_mtree = {}
 
-            if isdir(path):
-               continue
+    # extract into a staging directory first so that a failed download or
+    # extraction leaves the installed files untouched
+    os.makedirs(addons_dir, exist_ok=True)
 
-            with open(path, 'wb') as out, z.open(name) as zfile:
-                while True:
-                    chunk = zfile.read(4096)
-                    if not chunk:
-                        break
-                    m.update(chunk)
-                    out.write(chunk)
+    # clean up after previous runs that were killed before removing theirs,
+    # the '.' keeps e.g. foo from matching foo-bar's staging directories
+    prefix = '.staging-' + addon + '.'
+    for stale in glob.glob(os.path.join(glob.escape(addons_dir),
+                                        glob.escape(prefix) + '*')):
+        shutil.rmtree(stale, ignore_errors=True)
 
-            mtree.append([name, m.hexdigest()])
+    staging = tempfile.mkdtemp(prefix=prefix, dir=addons_dir)
 
-        with gzip.open(cachepath + '/MTREE', 'wt') as gz:
-            json.dump(mtree, gz)
+    try:
+        mtree = []
+        changed = []
+        with tmp, ZipFile(tmp) as z:
+            infos = [i for i in z.infolist() if not i.is_dir()]
+
+            for info in infos:
+                path = addon_path(addons_dir, info.filename)
+                if path is None:
+                    raise ValueError(addon + ' contains a file outside of the'
+                                     ' AddOns directory: ' + info.filename)
+
+                # keep files which are identical to the installed version
+                name = os.path.relpath(path, addons_dir).replace(os.sep, '/')
+                entry = old_mtree.get(name)
+                if entry is not None and len(entry) >= 5 and \
+                        (entry[2], entry[4]) == (info.file_size, info.CRC):
+                    try:
+                        st = os.stat(path)
+                        if (st.st_size, st.st_mtime_ns) == \
+                                (entry[2], entry[3]):
+                            mtree.append(entry)
+                            continue
+                    except FileNotFoundError:
+                        pass
+
+                changed.append(info)
+
+            # extract creates missing directories on its own
+            changed = [(info, z.extract(info, staging)) for info in changed]
+
+        # hash the extracted files in parallel
+        names = []
+        digests = hash_pool.map(hash_file, [path for _, path in changed])
+        for (info, path), digest in zip(changed, digests):
+            # record where extract actually put the file
+            name = os.path.relpath(path, staging).replace(os.sep, '/')
+            st = os.stat(path)
+            mtree.append([name, digest, st.st_size, st.st_mtime_ns, info.CRC])
+            names.append(name)
+
+        # remove files which are no longer part of the addon first, as one
+        # of them may be in the way of a new directory or the other way round
+        remove_files(old_mtree.keys() - {entry[0] for entry in mtree},
+                     addons_dir)
+
+        move_into_place(staging, addons_dir, names)
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+
+    write_mtree(cachepath, mtree)
+
+    # only record the new version once it has been installed completely
+    with open(version_file + '.tmp', 'w') as out:
+        out.write(new_version)
+    os.replace(version_file + '.tmp', version_file)
 
     print('Finished installing ' + addon + '.')
 
 # Check if addon is correctly installed
 def check_addon(addon, addons_dir):
-    cachepath = '.cache/' + addon
+    cachepath = os.path.join('.cache', addon)
     try:
-        with gzip.open(cachepath + '/MTREE', 'rt') as data_file:
-            data = json.load(data_file)
+        data = read_mtree(cachepath)
     except:
         # cache file does not exist
         return False
 
+    changed = []
+    changed_paths = []
     for entry in data:
-        m = hashlib.sha256()
+        path = addon_path(addons_dir, entry[0])
+        if path is None:
+            # manifest from before file names were checked
+            return False
+
         try:
-            with open(addons_dir + entry[0], 'rb') as f:
-                while True:
-                    chunk = f.read(4096)
-                    if not chunk:
-                        break
-                    m.update(chunk)
-
-            if m.hexdigest() != entry[1]:
-                # hash doen't match
-                return False
+            st = os.stat(path)
         except FileNotFoundError:
             # addon file is missing
             return False
 
-    return True
-
-def remove_addon(addon, addons_dir):
-    cachepath = '.cache/' + addon
+        # skip hashing files which haven't changed since installation
+        if len(entry) < 4 or (st.st_size, st.st_mtime_ns) != \
+                (entry[2], entry[3]):
+            changed.append(entry)
+            changed_paths.append(path)
 
     try:
-        with gzip.open(cachepath + '/MTREE', 'rt') as data_file:
-            data = json.load(data_file)
+        digests = hash_pool.map(hash_file, changed_paths)
+        # hash doesn't match
+        return all(d == e[1] for d, e in zip(digests, changed))
+    except FileNotFoundError:
+        # addon file is missing
+        return False
+
+# Removes the given files and any directories left empty by that
+def remove_files(names, addons_dir):
+    # never touch anything outside of the AddOns directory
+    names = [n for n in names if addon_path(addons_dir, n) is not None]
 
-        for entry in data:
+    # unlink relative to the AddOns directory where supported to save
+    # the path lookup for every file
+    dir_fd = None
+    if os.unlink in os.supports_dir_fd:
+        dir_fd = os.open(addons_dir, os.O_RDONLY | os.O_DIRECTORY)
+
+    try:
+        for name in names:
             try:
-                os.remove(addons_dir + entry[0])
+                if dir_fd is None:
+                    os.unlink(os.path.join(addons_dir, name))
+                else:
+                    os.unlink(name, dir_fd=dir_fd)
             except FileNotFoundError:
                 pass
+    finally:
+        if dir_fd is not None:
+            os.close(dir_fd)
+
+    # only clean up empty directories the files were in
+    top_dirs = {name.split('/')[0] for name in names if '/' in name}
+    with disk_lock:
+        for top in top_dirs:
+            for root, dirs, _ in os.walk(os.path.join(addons_dir, top),
+                                         topdown=False):
+                for name in dirs:
+                    try:
+                        os.rmdir(os.path.join(root, name))
+                    except OSError:
+                        pass
+            try:
+                os.rmdir(os.path.join(addons_dir, top))
+            except OSError:
+                pass
 
-        for root, dirs, _ in os.walk(addons_dir, topdown=False):
-            for name in dirs:
-                try:
-                    os.rmdir(os.path.join(root, name))
-                except OSError:
-                    pass
+def remove_addon(addon, addons_dir):
+    cachepath = os.path.join('.cache', addon)
+
+    try:
+        data = read_mtree(cachepath)
+        remove_files([entry[0] for entry in data], addons_dir)
     except FileNotFoundError:
         print('ERROR: MTREE for ' + addon + ' could not be found.'
               ' Nothing has been removed.')
 
+def parse_args():
+    parser = argparse.ArgumentParser(prog='pywamgr.py', description=__doc__)
+    parser.add_argument('--version', action='version', version='0.1-alpha')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    install = subparsers.add_parser('install', help='Install addons.')
+    install.add_argument('addons', nargs='+', metavar='addon',
+                         help='Addon name')
+
+    update = subparsers.add_parser('update', help='Update addons.')
+    update.add_argument('addons', nargs='*', metavar='addon',
+                        help='Addon name')
+    update.add_argument('--all', action='store_true', help='Update all addons.')
+
+    remove = subparsers.add_parser('remove', help='Remove addons.')
+    remove.add_argument('addons', nargs='+', metavar='addon',
+                        help='Addon name')
+
+    args = parser.parse_args()
+
+    # argparse can't express (<addon>... | --all) with a mutually exclusive
+    # group, as an empty positional list always counts as given
+    if args.command == 'update':
+        if args.all and args.addons:
+            update.error('addon names and --all are mutually exclusive')
+        if not args.all and not args.addons:
+            update.error('either addon names or --all is required')
+
+    return args
+
 if __name__ == '__main__':
-    args = docopt(__doc__, version='0.1-alpha')
+    args = parse_args()
 
     config_file = expanduser('~/.pywamgr.yaml')
 
     try:
         with open(config_file) as yamlfile:
-            cfg = yaml.load(yamlfile)
+            cfg = yaml.load(yamlfile, Loader=Loader)
 
     except FileNotFoundError:
         # load and dump default configuration
         cfg = yaml.load("""
             wow_directory: C:/Program Files/World of Warcraft
             addons: []
-        """)
+        """, Loader=Loader)
 
     cfg_changed = False
     install_dir = cfg['wow_directory'] + '/Interface/AddOns/'
@@ -177,21 +410,31 @@ if __name__ == '__main__':
     if not isfile(cfg['wow_directory'] + '/Wow.exe'):
         print('Warning: no WoW installation found at ' + cfg['wow_directory'])
 
-    if args['install'] or args['update']:
-        if args['--all']:
+    if args.command in ('install', 'update'):
+        if args.command == 'update' and args.all:
             addons = cfg['addons']
         else:
-            addons = args['<addon>']
+            # every addon must only be updated by one worker at a time
+            addons = list(dict.fromkeys(args.addons))
 
         for addon in addons:
             if not addon in cfg['addons']:
                 cfg['addons'].append(addon)
                 cfg_changed = True
 
-            update_addon(addon, install_dir)
-
-    if args['remove']:
-        for addon in args['<addon>']:
+        # fetch project data and download addons in two overlapping stages
+        with ThreadPoolExecutor(max_workers=8) as meta_pool, \
+                ThreadPoolExecutor(max_workers=4) as dl_pool:
+            meta = {meta_pool.submit(get_curse_addon_data, a): a
+                    for a in addons}
+            futs = [dl_pool.submit(update_addon, meta[f], install_dir,
+                                   f.result())
+                    for f in as_completed(meta)]
+            for f in as_completed(futs):
+                f.result()
+
+    if args.command == 'remove':
+        for addon in args.addons:
             try:
                 cfg['addons'].remove(addon)
                 cfg_changed = True
@@ -200,9 +443,9 @@ if __name__ == '__main__':
                 continue
 
             remove_addon(addon, install_dir)
-            shutil.rmtree('.cache/' + addon)
+            shutil.rmtree(os.path.join('.cache', addon))
 
     # save new configuration
     if cfg_changed:
         with open(config_file, 'w') as yamlfile:
-            yaml.dump(cfg, yamlfile)
+            yaml.dump(cfg, yamlfile, Dumper=Dumper)